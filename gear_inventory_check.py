@@ -36,18 +36,38 @@ License:
 """
 
 import sys
+import atexit
+import asyncio
+import base64
 import os
+import re
 import click
-import json
-import requests
 import sqlite3
+import hashlib
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from requests.auth import HTTPBasicAuth
-from datetime import date
+from functools import lru_cache
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
-from envelopes import Envelope
-from smtplib import SMTPException # allow for silent fail in try exception
-from pprint import pprint
+
+PER_PAGE = 100  # WooCommerce REST maximum page size
+POOL_SIZE = 16  # connections the API client may open
+TIMEOUT = 30.0  # seconds to wait on any one API request
+BATCH_SIZE = 50  # pages issued per work queue batch
+MAX_IN_FLIGHT = 8  # API requests outstanding at once
+RETRIES = 3  # extra attempts for a page answered with a retryable status
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+BACKOFF = 0.5  # seconds, doubled for each retry unless Retry-After says otherwise
+MAX_BACKOFF = 30  # longest wait in seconds before any one retry
+PRODUCT_FIELDS = ('id', 'name', 'type', 'stock_quantity')  # kept from each API record
+
+_ADDRESS_RE = re.compile(r'\s*(?:(?P<name>[^<]*?)\s*)?<?(?P<addr>[^<>\s]+@[^<>\s]+)>?\s*')
+
+_outbox = []  # (subject, html body, to) waiting for flush_mail
+_mail_pool = ThreadPoolExecutor(max_workers=2)
+atexit.register(_mail_pool.shutdown, wait=True)
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -59,6 +79,7 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+@lru_cache(maxsize=None)
 def split_address(email_address):
     """Return a tuple of (address, name), name may be an empty string
        Can convert the following forms
@@ -67,20 +88,56 @@ def split_address(email_address):
          Example <example@example.com>
          Example<example@example.com>
     """
-    address = email_address.split('<')
-    if len(address) == 1:
-        return (address[0], '')
-    if address[0]:
-        return (address[1][:-1], address[0].strip())
-    return (address[1][:-1], '')
+    match = _ADDRESS_RE.fullmatch(email_address)
+    if match is None:
+        return (email_address.strip(), '')
+    return (match.group('addr'), (match.group('name') or '').strip())
+
+def format_address(email_address):
+    """return an address in any split_address form as a header value"""
+    from email.utils import formataddr  # pylint: disable=import-outside-toplevel
+    address, name = split_address(email_address.strip())
+    return formataddr((name, address))
+
+def mail_batch(messages):
+    """send (subject, html body, to) messages over one smtp session"""
+    # pylint: disable=import-outside-toplevel
+    import smtplib
+    from email.message import EmailMessage
+    if not os.environ.get('MAIL_FROM'):
+        raise ValueError("MAIL_FROM is not set")
+    sender = format_address(os.environ.get('MAIL_FROM'))
+    with smtplib.SMTP(os.environ.get('MAIL_SERVER'), int(os.environ.get('MAIL_PORT', 25))) as smtp:
+        smtp.starttls()
+        if os.environ.get('MAIL_LOGIN'):
+            smtp.login(os.environ.get('MAIL_LOGIN'), os.environ.get('MAIL_PASSWORD'))
+        for subject, html, to in messages:
+            msg = EmailMessage()
+            msg['From'] = sender
+            msg['To'] = to
+            msg['Subject'] = subject
+            msg.set_content(html, subtype='html')
+            smtp.send_message(msg)
+
+def report_mail_failure(future):
+    """print why a background mail batch failed to stderr"""
+    error = future.exception()
+    if error is not None:
+        click.echo(f"unable to send mail: {error!r}", err=True)
 
 def mail_results(subject, body):
-    """ Send emial with html formatted body and parameters from env"""
-    envelope = Envelope(
-        from_addr=split_address(os.environ.get('MAIL_FROM')),
-        subject=subject,
-        html_body=body
-    )
+    """queue emial with html formatted body and parameters from env"""
+    from email.utils import formataddr, getaddresses  # pylint: disable=import-outside-toplevel
+    to = ', '.join(formataddr((name, address))
+                   for name, address in getaddresses([os.environ.get('MAIL_TO', '')]) if address)
+    _outbox.append((subject, body, to))
+
+def flush_mail():
+    """send all queued mail over one smtp session on a background thread"""
+    if _outbox:
+        messages = list(_outbox)
+        _outbox.clear()
+        _mail_pool.submit(mail_batch, messages).add_done_callback(report_mail_failure)
 
 def email_admins(low, status):
     """eamil admins about cartridge status"""
@@ -107,15 +164,12 @@ def email_status(low, status):  # pylint: disable=unused-argument
 def format_list(cartridges):
     """format cartridge list"""
 
-    text  = ""
-    for row in cartridges:
-        line = (f"    {row['cartridge']:20}  "
-                f"{'(' + row['letter'] + ')':4}  "
-                f"{row['part']}  "
-                f"{row['level']:>5}  "
-                f"{row['status']}\n")
-        text += line
-    return text
+    return "".join(f"    {row['cartridge']:20}  "
+                   f"{'(' + row['letter'] + ')':4}  "
+                   f"{row['part']}  "
+                   f"{row['level']:>5}  "
+                   f"{row['status']}\n"
+                   for row in cartridges)
 
 @contextmanager
 def db_ops(db_name):
@@ -123,61 +177,201 @@ def db_ops(db_name):
     connection = sqlite3.connect(db_name,isolation_level=None)
     connection.row_factory = sqlite3.Row
     cursor = connection.cursor()
-    yield cursor
-    connection.commit()
-    connection.close()
+    cursor.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+    """)
+    # statements autocommit unless inside this one explicit write transaction
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        yield cursor
+        connection.commit()
+    finally:
+        connection.close()
 
 def create_database(cursor):
     """create database tables if needed"""
-    schema = """ 
+    columns = {row['name'].upper() for row in cursor.execute("PRAGMA table_info(INVENTORY)")}
+    legacy = 'QUANTITY' in columns
+    if legacy:
+        cursor.execute("ALTER TABLE INVENTORY RENAME TO INVENTORY_LEGACY")
+    schema = """
         CREATE TABLE IF NOT EXISTS INVENTORY (
-            DATE     CHAR(19)        NOT NULL, 
-            ID       INT             NOT NULL,
-            NAME     VARCHAR(255)    NOT NULL, 
-            QUANTITY REAL            NOT NULL);
+            DATE_ONLY TEXT            NOT NULL,
+            TS        TEXT            NOT NULL,
+            ID        INTEGER         NOT NULL,
+            NAME      TEXT            NOT NULL,
+            QTY_X100  INTEGER         NOT NULL,
+            HASH      BLOB            NOT NULL,
+            DELETED   INTEGER         NOT NULL DEFAULT 0,
+            PRIMARY KEY (DATE_ONLY, ID)) WITHOUT ROWID;
     """
     cursor.execute(schema)
-
-
-
-def handle_variation(variations):
-    """process a list of variation ids"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inv_id_date ON INVENTORY(ID, DATE_ONLY)")
+    if legacy:
+        # older rows get an empty hash so the first run stores a full snapshot;
+        # for same day duplicates the row inserted last wins
+        cursor.execute("""
+            INSERT OR REPLACE INTO INVENTORY(DATE_ONLY, TS, ID, NAME, QTY_X100, HASH)
+            SELECT date(DATE), DATE, ID, NAME, CAST(round(QUANTITY * 100) AS INTEGER), X''
+              FROM INVENTORY_LEGACY
+          ORDER BY rowid;""")
+        # the old table held a full snapshot per day, so a product missing from
+        # a day that was there the day before left the store on that day
+        cursor.execute("""
+            WITH days AS (SELECT DATE_ONLY AS d, LAG(DATE_ONLY) OVER (ORDER BY DATE_ONLY) AS p, MIN(TS) AS ts
+                            FROM INVENTORY GROUP BY DATE_ONLY)
+            INSERT INTO INVENTORY(DATE_ONLY, TS, ID, NAME, QTY_X100, HASH, DELETED)
+            SELECT days.d, days.ts, y.ID, y.NAME, 0, X'', 1
+              FROM days
+              JOIN INVENTORY y ON y.DATE_ONLY = days.p
+             WHERE NOT EXISTS (SELECT 1 FROM INVENTORY t WHERE t.DATE_ONLY = days.d AND t.ID = y.ID);""")
+        cursor.execute("DROP TABLE INVENTORY_LEGACY")
+    # last ETag, page count and trimmed items seen for each API page
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS HTTP_CACHE (
+            URL         TEXT        NOT NULL PRIMARY KEY,
+            ETAG        TEXT        NOT NULL,
+            TOTAL_PAGES INTEGER     NOT NULL,
+            BODY        BLOB        NOT NULL);
+    """)
+
+class PageCache:
+    """etag cache of api pages as {url: (etag, total pages, body)}"""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.seen = {}
+
+    def get(self, url):
+        """return the stored entry for url, or None"""
+        return self.entries.get(url)
+
+    def put(self, url, entry):
+        """record the entry used for url this run"""
+        self.seen[url] = entry
+
+def load_http_cache(cursor):
+    """return the http cache as a PageCache"""
+    return PageCache({row['url']: (row['etag'], row['total_pages'], row['body'])
+                      for row in cursor.execute("SELECT url, etag, total_pages, body FROM http_cache")})
+
+def save_http_cache(cursor, cache):
+    """store new or changed entries of a PageCache and drop those not seen this run"""
+    cursor.executemany("""INSERT OR REPLACE INTO http_cache(url, etag, total_pages, body) VALUES(?, ?, ?, ?);""",
+                       [(url, *entry) for url, entry in cache.seen.items() if cache.entries.get(url) != entry])
+    cursor.executemany("""DELETE FROM http_cache WHERE url = ?;""",
+                       [(url,) for url in cache.entries if url not in cache.seen])
+
+def record_hash(product):
+    """return a short digest of the stored fields of a product"""
+    return hashlib.blake2b(f"{product['name']}|{product['quantity']}".encode(), digest_size=16).digest()
+
+
+
+def api_client(user, password):
+    """create an http/2 client for the woocommerce api"""
+    import httpx  # pylint: disable=import-outside-toplevel
+    transport = httpx.AsyncHTTPTransport(
+        http2=True, retries=3, limits=httpx.Limits(max_connections=POOL_SIZE))
+    token = base64.b64encode(f"{user}:{password}".encode()).decode()
+    return httpx.AsyncClient(transport=transport, timeout=TIMEOUT,
+                             headers={'Authorization': f'Basic {token}'})
+
+class StreamReader:  # pylint: disable=too-few-public-methods
+    """expose an httpx response body as an async file for ijson"""
+
+    def __init__(self, response):
+        self.chunks = response.aiter_bytes()
+
+    async def read(self, size=-1):
+        """return the next chunk of the body, b'' once it is exhausted"""
+        if size == 0:  # ijson probes with read(0) to learn bytes vs str
+            return b''
+        async for chunk in self.chunks:
+            if chunk:
+                return chunk
+        return b''
+
+def retry_delay(response, attempt):
+    """seconds to wait before retrying, honouring a numeric Retry-After"""
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(int(retry_after), MAX_BACKOFF)
+    return min(BACKOFF * 2 ** attempt, MAX_BACKOFF)
+
+async def fetch_page(client, limit, cache, url, page):
+    """return (items, total pages) for one page of a paginated endpoint"""
+    import ijson  # pylint: disable=import-outside-toplevel
+    cache_key = f"{url}?per_page={PER_PAGE}&page={page}"
+    cached = cache.get(cache_key)
+    headers = {'If-None-Match': cached[0]} if cached else {}
+    for attempt in range(RETRIES + 1):
+        async with limit, client.stream('GET', url, params={"per_page": PER_PAGE, "page": page},
+                                        headers=headers) as response:
+            if response.status_code in RETRY_STATUSES and attempt < RETRIES:
+                delay = retry_delay(response, attempt)
+            else:
+                if cached and response.status_code == 304:
+                    cache.put(cache_key, cached)
+                    return json.loads(cached[2]), cached[1]
+                response.raise_for_status()
+                items = [{key: item.get(key) for key in PRODUCT_FIELDS}
+                         async for item in ijson.items(StreamReader(response), 'item', use_float=True)]
+                total_pages = int(response.headers.get('X-WP-TotalPages', 1))
+                if response.status_code == 200 and 'ETag' in response.headers:
+                    cache.put(cache_key, (response.headers['ETag'], total_pages, json.dumps(items).encode()))
+                return items, total_pages
+        await asyncio.sleep(delay)
+
+async def fetch_all(client, limit, cache, url):
+    """fetch page 1, then the remaining pages of an endpoint concurrently"""
+    items, total_pages = await fetch_page(client, limit, cache, url, 1)
+    pages = await asyncio.gather(*[fetch_page(client, limit, cache, url, page) for page in range(2, total_pages + 1)])
+    for page_items, _ in pages:
+        items.extend(page_items)
+    return items
+
+async def handle_variations(client, limit, cache, base, variations):
+    """process the top level variation list of dictionaries"""
+    frontier = deque((f"{base}products/{variation['id']}/variations", 1)
+                     for variation in variations)
     products = []
-    for variation in variations:
-        response = requests.get(os.getenv('API_BASE') + 'products/' + str(variation), auth = HTTPBasicAuth(os.getenv('API_USER'), os.getenv('API_PASS')))
-        item = json.loads( json.dumps(response.json()) )
-        if item['variations']:
-            products = products + handle_variations(item['variations'])
-        else:
-            products.append({"id": item["id"], "name": item["name"], "quantity": item["stock_quantity"]})
+    while frontier:
+        batch = [frontier.popleft() for _ in range(min(len(frontier), BATCH_SIZE))]
+        results = await asyncio.gather(*[fetch_page(client, limit, cache, *job) for job in batch])
+        for (url, page), (items, total_pages) in zip(batch, results):
+            products.extend({"id": x["id"], "name": x["name"], "quantity": x["stock_quantity"]} for x in items)
+            if page == 1:
+                frontier.extend((url, page) for page in range(2, total_pages + 1))
     return products
 
-
-def handle_variations(variations):
-    """process the top level variation list of dictionaries"""
-    products = []
-    for variation in variations:
-        products = products + handle_variation(variation["variations"])
+async def pull_stock_values(base, user, password, cache):
+    """pull simple products and every variation of variable products"""
+    limit = asyncio.Semaphore(MAX_IN_FLIGHT)
+    async with api_client(user, password) as client:
+        all = await fetch_all(client, limit, cache, base + 'products/')
+        products, variations = [], []
+        for x in all:
+            if x['type'] == 'simple':
+                products.append({"id": x['id'], "name": x['name'], "quantity": x['stock_quantity']})
+            elif x['type'] == 'variable':
+                variations.append(x)
+        products.extend(await handle_variations(client, limit, cache, base, variations))
     return products
 
-def get_current_stock_values():
+def get_current_stock_values(cache):
     """x"""
-    response = requests.get(os.getenv('API_BASE') + 'products/', auth = HTTPBasicAuth(os.getenv('API_USER'), os.getenv('API_PASS')))
-
-    all = json.loads( json.dumps(response.json()) )
-    simple = [x for x in all if x['type'] == 'simple']
-    variations = [x for x in all if x['type'] == 'variable']
-
-    products = [{"id": x['id'], "name": x['name'], "quantity": x['stock_quantity']} for x in all  if x['type'] == 'simple']
-    products = products + handle_variations(variations)
-    return products
+    return asyncio.run(pull_stock_values(
+        os.getenv('API_BASE'), os.getenv('API_USER'), os.getenv('API_PASS'), cache))
 
 def format_products(products):
     """create formated list"""
-    output = ""
-    for product in products:
-        output += f"{product['quantity']:7.2f}   {product['name']}\n"
-    return output
+    return "".join(f"{product['quantity']:7.2f}   {product['name']}\n"
+                   for product in products)
 
 # pylint: disable=no-value-for-parameter
 @click.command()
@@ -195,60 +389,102 @@ def main(debug, print_arg, status, date1):
     # load environmental variables
     load_dotenv(dotenv_path=resource_path(".env"))
 
-    sql1 = """
-        SELECT t.id as id, t.name as name, t.quantity as quantity, y.quantity as change
-        FROM inventory t
-        JOIN inventory y ON t.id = y.id AND date(y.date) = '2024-01-02'
-        WHERE date(t.date) = '2024-01-03'
-        ORDER BY t.name;"""
+    # rows are only stored on days a product changes, so the inventory as of
+    # a day is the latest row per product on or before that day, unless that
+    # row marks the product as deleted
+    snapshot = """
+        SELECT i.ts as date, i.id as id, i.name as name, i.qty_x100 / 100.0 as quantity, i.hash as hash
+          FROM (SELECT id, MAX(date_only) AS d FROM inventory WHERE date_only <= ? GROUP BY id) latest
+          JOIN inventory i ON i.date_only = latest.d AND i.id = latest.id
+         WHERE NOT i.deleted"""
 
+    # products that changed on a day along with how much they moved by
     sql = """
-        SELECT t.id as id, t.name as Item, t.quantity as Quantity, y.quantity - t.quantity as change
+        SELECT t.id as id, t.name as name, t.qty_x100 / 100.0 as quantity, (y.qty_x100 - t.qty_x100) / 100.0 as change
           FROM inventory t
-          JOIN (SELECT id, quantity FROM inventory WHERE date = '2024-01-02') y on t.id = y.id
-         WHERE date(t.date) = '2024-01-03'
+          LEFT JOIN inventory y ON y.id = t.id AND NOT y.deleted
+           AND y.date_only = (SELECT MAX(date_only) FROM inventory WHERE id = t.id AND date_only < t.date_only)
+         WHERE t.date_only = ? AND NOT t.deleted
       ORDER BY t.name;"""
 
-    # always pull current inventory
-    products = get_current_stock_values()
-
-    # database stuff
-    with db_ops(os.getenv("DB_FILE")) as cursor:
-        create_database(cursor)
-        cursor.execute("""DELETE FROM inventory WHERE date(date) = ?;""", (date.today().strftime("%Y-%m-%d"),))
-        cursor.execute("VACUUM")
-        cursor.executemany("""INSERT INTO inventory(date, id, name, quantity) VALUES(datetime('now', 'localtime'), :id, :name, :quantity);""", products)
-        # find prior day
-        before = cursor.execute("""SELECT DISTINCT date(date) AS date from inventory WHERE date(date) < date(?) ORDER BY date DESC LIMIT 1;""", (today,)).fetchone()
-        yesterday = before['date']
-        # get rows for requested date
-        rows1 = cursor.execute("""SELECT date, id, name, quantity FROM inventory WHERE date(date) = ? ORDER BY name""", (today ,)).fetchall()
-        # get day before requested date
-        rows2 = cursor.execute("""SELECT date, id, name, quantity FROM inventory WHERE date(date) = ? ORDER BY name""", (yesterday ,)).fetchall()
-        # the full monty
-        rows3 = cursor.execute(sql).fetchall()
-
-    # output todays inventory to new.txt
-    with open('/tmp/new.txt', 'w') as f:
-        print("QTY       ITEM                                                                    ", file=f)
-        print("-------   ------------------------------------------------------------------------", file=f)
-        for row in rows1:
-            print(f"{row['quantity']:7.2f}   {row['name']}", file=f)
-
-    # output yesterdays inventory to old.txt
-    with open('/tmp/old.txt', 'w') as f:
-        print("QTY       ITEM                                                                    ", file=f)
-        print("-------   ------------------------------------------------------------------------", file=f)
-        for row in rows2:
-            print(f"{row['quantity']:7.2f}   {row['name']}", file=f)
-
-    if print_arg:
-        # save as new
-        for row in rows3:
-            if row['change'] == 77:
-                print(f"        {row['quantity']:7.2f}  {row['name']}")
-            else:
-                print(f"{row['change']:7.2f} {row['quantity']:7.2f}  {row['name']}")
+    try:
+        with db_ops(os.getenv("DB_FILE")) as cursor:
+            create_database(cursor)
+            cache = load_http_cache(cursor)
+
+        # always pull current inventory
+        products = get_current_stock_values(cache)
+        if not products:
+            # an empty pull would mark every product deleted
+            raise click.ClickException("no products returned from the store, inventory not updated")
+
+        # database stuff
+        with db_ops(os.getenv("DB_FILE")) as cursor:
+            save_http_cache(cursor, cache)
+            # only store products whose hash moved since the last stored day
+            stamp = datetime.now().isoformat(sep=' ', timespec='seconds')
+            day = date.today()
+            prior = (day - timedelta(days=1)).isoformat()
+            day = day.isoformat()
+            previous = {row['id']: row for row in cursor.execute(snapshot, (prior,))}
+            changed = []
+            unchanged = []
+            for product in products:
+                digest = record_hash(product)
+                row = previous.pop(product['id'], None)
+                if row is None or row['hash'] != digest:
+                    changed.append((stamp, day, product['id'], product['name'], int(round(product['quantity'] * 100)), digest, 0))
+                else:
+                    unchanged.append((day, product['id']))
+            # whatever is left in previous is no longer in the store
+            changed.extend((stamp, day, row['id'], row['name'], 0, b'', 1) for row in previous.values())
+            cursor.executemany("""
+                INSERT INTO inventory(ts, date_only, id, name, qty_x100, hash, deleted)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(date_only, id) DO UPDATE
+                   SET ts = excluded.ts, name = excluded.name, qty_x100 = excluded.qty_x100,
+                       hash = excluded.hash, deleted = excluded.deleted;""", changed)
+            # a product changed by an earlier run today may have changed back since
+            cursor.executemany("""DELETE FROM inventory WHERE date_only = ? AND id = ?;""", unchanged)
+            # a product first added by an earlier run today may be gone again
+            pulled = {product['id'] for product in products}
+            added = cursor.execute("""SELECT id FROM inventory WHERE date_only = ? AND NOT deleted;""", (day,)).fetchall()
+            cursor.executemany("""DELETE FROM inventory WHERE date_only = ? AND id = ?;""",
+                               [(day, row['id']) for row in added if row['id'] not in pulled and row['id'] not in previous])
+            # find prior day
+            before = cursor.execute("""SELECT MAX(date_only) AS date from inventory WHERE date_only < ?;""", (today,)).fetchone()
+            yesterday = before['date']
+            # get rows for requested date
+            rows1 = cursor.execute(snapshot + " ORDER BY name", (today ,)).fetchall()
+            # get day before requested date
+            rows2 = cursor.execute(snapshot + " ORDER BY name", (yesterday ,)).fetchall()
+            # the full monty
+            rows3 = cursor.execute(sql, (today,)).fetchall()
+
+        # output todays inventory to new.txt
+        with open('/tmp/new.txt', 'w') as f:
+            print("QTY       ITEM                                                                    ", file=f)
+            print("-------   ------------------------------------------------------------------------", file=f)
+            for row in rows1:
+                print(f"{row['quantity']:7.2f}   {row['name']}", file=f)
+
+        # output yesterdays inventory to old.txt
+        with open('/tmp/old.txt', 'w') as f:
+            print("QTY       ITEM                                                                    ", file=f)
+            print("-------   ------------------------------------------------------------------------", file=f)
+            for row in rows2:
+                print(f"{row['quantity']:7.2f}   {row['name']}", file=f)
+
+        if print_arg:
+            # save as new
+            for row in rows3:
+                if row['change'] is None:
+                    print(f"        {row['quantity']:7.2f}  {row['name']}")
+                else:
+                    print(f"{row['change']:7.2f} {row['quantity']:7.2f}  {row['name']}")
+    finally:
+        # send anything queued by email_admins/email_status in one smtp session
+        flush_mail()
 
 if __name__ == "__main__":
     main()